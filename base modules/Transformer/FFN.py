@@ -1,48 +1,107 @@
+from functools import partial
+from typing import Callable, Optional, Union
+
 import torch
 from torch import nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
 from labml_helpers.module import Module
 
+from .parallel import (TensorParallelGroup, copy_to_tensor_parallel_region, init_sharded_linear_,
+                       reduce_from_tensor_parallel_region)
+
+# Activations selectable by name; plain functions so the compiler can fold them into the GEMM epilogue
+ACTIVATIONS = {
+    'relu': F.relu,
+    'gelu': partial(F.gelu, approximate='tanh'),
+    'silu': F.silu,
+}
+
 class FeedForward(Module):
     def __init__(self, d_model: int, d_ff: int,
                  dropout: float = 0.1,
-                 activation=nn.ReLU(),
+                 activation: Union[str, Callable[[torch.Tensor], torch.Tensor]] = 'relu',
                  is_gated: bool = False,
                  bias1: bool = True,
                  bias2: bool = True,
-                 bias_gate: bool = True):
+                 bias_gate: bool = True,
+                 tp_group: Optional[dist.ProcessGroup] = None):
         '''
 d_model 是标记嵌入中的特征数量
 d_ff 是 FFN 隐藏层中的特征数量
 dropout 是隐藏层的 Dropout 率
+activation 是激活函数, 可以是 'relu'、'gelu'(tanh 近似)、'silu' 或任意可调用对象
 is_gated 指定了隐藏层是否为门控层
 bias1 指定了第一个全连接层是否应该具有可学习的偏置
 bias2 指定第二个全连接层是否应具有可学习的偏置
 bias_gate 指定门控的全连接层是否应具有可学习的偏置
+tp_group 是张量并行的进程组, 指定后每个 rank 只持有 d_ff/N 个隐藏单元; 所有 rank 必须使用相同的随机种子
         '''
         super().__init__()
+        # With tensor parallelism over $N$ ranks, layer one is split by columns and layer two
+        # by rows, so the element-wise activation stays local and the outputs need a single all-reduce
+        self.tp = TensorParallelGroup(tp_group) if tp_group is not None else None
+        tp_size = 1 if self.tp is None else self.tp.size
+        assert d_ff % tp_size == 0
+        d_ff = d_ff // tp_size
+        # Whether there is a gate
+        self.is_gated = is_gated
+        # If there is a gate with the same bias setting as layer one, $W_1$ and $V$ are
+        # stored as a single $[2 d_{ff}, d_{model}]$ linear layer so both are computed by one GEMM
+        self.is_fused_gate = is_gated and bias1 == bias_gate
         # Layer one parameterized by weight $W_1$ and bias $b_1$
-        self.layer1 = nn.Linear(d_model, d_ff, bias=bias1)
+        self.layer1 = nn.Linear(d_model, 2 * d_ff if self.is_fused_gate else d_ff, bias=bias1)
+        # $W_1$ and $V$ are still two matrices, so initializers compute the fan values of each half
+        self.layer1.fan_blocks = 2 if self.is_fused_gate else 1
         # Layer one parameterized by weight $W_1$ and bias $b_1$
-        self.layer2 = nn.Linear(d_ff, d_model, bias=bias2)
+        self.layer2 = nn.Linear(d_ff, d_model, bias=bias2 and tp_group is None)
+        # When split, the bias $b_2$ is added once after the all-reduce; it is initialized with layer two below
+        self.bias2 = nn.Parameter(torch.empty(d_model)) if bias2 and tp_group is not None else None
         # Hidden layer dropout
         self.dropout = nn.Dropout(dropout)
         # Activation function $f$
-        self.activation = activation
-        # Whether there is a gate
-        self.is_gated = is_gated
-        if is_gated:
+        self.activation = ACTIVATIONS[activation] if isinstance(activation, str) else activation
+        if is_gated and not self.is_fused_gate:
             # If there is a gate the linear layer to transform inputs to
             # be multiplied by the gate, parameterized by weight $V$ and bias $c$
             self.linear_v = nn.Linear(d_model, d_ff, bias=bias_gate)
+        if self.tp is not None:
+            # Mark the split dimension of each shard and initialize it as a slice of the unsplit layer
+            self.layer1.tp_shard = (0, self.tp)
+            self.layer2.tp_shard = (1, self.tp)
+            init_sharded_linear_(self.layer1)
+            init_sharded_linear_(self.layer2, bias=self.bias2)
+            if is_gated and not self.is_fused_gate:
+                self.linear_v.tp_shard = (0, self.tp)
+                init_sharded_linear_(self.linear_v)
     
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved with separate $W_1$ and $V$ layers are concatenated into the fused layer one
+        if self.is_fused_gate:
+            for name in ('weight', 'bias'):
+                k1, kv = f'{prefix}layer1.{name}', f'{prefix}linear_v.{name}'
+                if k1 in state_dict and kv in state_dict:
+                    state_dict[k1] = torch.cat([state_dict[k1], state_dict.pop(kv)])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self,x:torch.Tensor):
-        g = self.activation(self.layer1(x))
-        if self.is_gated:
-            x = g * self.linear_v(x)
+        if self.tp is not None:
+            x = copy_to_tensor_parallel_region(x, self.tp.group)
+        if self.is_fused_gate:
+            # $f(x W_1 + b_1) \otimes (x V + c)$ from the two halves of one GEMM
+            g, v = self.layer1(x).chunk(2, dim=-1)
+            x = self.activation(g) * v
+        elif self.is_gated:
+            x = self.activation(self.layer1(x)) * self.linear_v(x)
         else:
-            x = g
+            x = self.activation(self.layer1(x))
         x = self.dropout(x)
-        return self.layer2(x)                
+        x = self.layer2(x)
+        if self.tp is not None:
+            x = reduce_from_tensor_parallel_region(x, self.tp.group)
+            if self.bias2 is not None:
+                x = x + self.bias2
+        return x                
         
 
 
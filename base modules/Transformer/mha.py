@@ -3,67 +3,165 @@ from typing import Optional,List
 
 import torch
 from torch import nn
+import torch.nn.functional as F
+import torch.distributed as dist
 
 from labml import tracker
 
-class PrepareForMultiHeadAttention(nn.Module):
-    '''
-    该部分执行线性变换，并将向量分割成给定数量的头以获得多头注意力。这用于键、查询和值向量。
-    '''
-    def __init__(self,d_model:int,heads:int,d_k:int,bias:bool) -> None:
-        super().__init__()
-        self.linear = nn.Linear(in_features=d_model,out_features=heads*d_k)
-        self.heads = heads
-        self.d_k = d_k
-    def forward(self,x:torch.Tensor):
-        #输入的形状为[seq_len, batch_size, d_model] 或[batch_size, d_model] 。我们对最后一维应用线性变换，并将其分为多个头。
-        #输出具有形状[seq_len, batch_size, heads, d_k] 或[batch_size, heads, d_model]
-        head_shape = x.shape[:-1]
-        x = self.linear(x)
-        x = x.view(*head_shape,self.heads,self.d_k)
-        return x
-    
+from .parallel import (TensorParallelGroup,copy_to_tensor_parallel_region,init_sharded_linear_,
+                       reduce_from_tensor_parallel_region)
+
+try:
+    from flash_attn import flash_attn_func
+except ImportError:
+    flash_attn_func = None
+
+if flash_attn_func is not None:
+    #注册为自定义算子, torch.compile 把它当作一个不透明的节点, 不会因为调用扩展而 graph break
+    @torch.library.custom_op("base_models::flash_attn",mutates_args=())
+    def flash_attention(query:torch.Tensor,key:torch.Tensor,value:torch.Tensor,
+                        dropout_p:float,softmax_scale:float,causal:bool) -> torch.Tensor:
+        #输入和输出的形状为[batch_size, seq_len, heads, d_k], 数据类型为 fp16 或 bf16
+        return flash_attn_func(query,key,value,dropout_p=dropout_p,softmax_scale=softmax_scale,causal=causal)
+
+    @flash_attention.register_fake
+    def _(query,key,value,dropout_p,softmax_scale,causal):
+        return query.new_empty(query.shape)
+
 class MultiHeadAttention(nn.Module):    
-    def __init__(self,heads:int,d_model:int,dropout_prob:float = 0.1,bias:bool = True):
+    def __init__(self,heads:int,d_model:int,dropout_prob:float = 0.1,bias:bool = True,
+                 tp_group:Optional[dist.ProcessGroup] = None):
+        '''
+        tp_group 是张量并行的进程组, 指定后每个 rank 只计算 heads/N 个头: qkv 按列切分, output 按行切分;
+        所有 rank 必须使用相同的随机种子
+        '''
         super().__init__()
         #d_k特征数量
         self.d_k = d_model // heads
-        self.heads = heads
-        self.query = PrepareForMultiHeadAttention(d_model,heads,self.d_k,bias)
-        self.key = PrepareForMultiHeadAttention(d_model, heads, self.d_k, bias=bias)
-        self.value = PrepareForMultiHeadAttention(d_model, heads, self.d_k, bias=True)
-        self.softmax = nn.Softmax(dim=1)
-        self.output = nn.Linear(d_model,d_model)
+        self.tp = TensorParallelGroup(tp_group) if tp_group is not None else None
+        tp_size = 1 if self.tp is None else self.tp.size
+        assert heads % tp_size == 0
+        #本 rank 上的头数
+        self.heads = heads // tp_size
+        #查询、键、值的投影合并为一个[3*heads*d_k, d_model]的线性层, 自注意力时一次 GEMM 完成
+        self.qkv = nn.Linear(d_model,3*self.heads*self.d_k,bias=bias)
+        #初始化时按查询、键、值三个矩阵分别计算 fan_in/fan_out
+        self.qkv.fan_blocks = 3
+        self.output = nn.Linear(self.heads*self.d_k,d_model,bias=tp_group is None)
+        #切分时输出的偏置在 all-reduce 之后只加一次, 与 output 一起初始化
+        self.output_bias = nn.Parameter(torch.empty(d_model)) if tp_group is not None else None
+        if self.tp is not None:
+            #标明切分的维度, 并作为未切分线性层的一部分初始化
+            self.qkv.tp_shard = (0,self.tp)
+            self.output.tp_shard = (1,self.tp)
+            init_sharded_linear_(self.qkv)
+            init_sharded_linear_(self.output,bias=self.output_bias)
         self.dropout = nn.Dropout(dropout_prob)
         self.scale = 1 / math.sqrt(self.d_k)
+        #是否保存注意力权重(需要走显式计算路径,SDPA不返回权重)
+        self.is_save_attn = False
         self.attn = None
+    def _load_from_state_dict(self,state_dict,prefix,*args,**kwargs):
+        #兼容 query/key/value 分开投影时保存的权重, 按顺序拼接到 qkv 中
+        for name in ('weight','bias'):
+            if name == 'bias' and self.qkv.bias is None:
+                #旧版本的投影总是带偏置(忽略了 bias 参数); bias=False 时保留原来的键, 不拼接也不静默丢弃,
+                #load_state_dict 把它们报告为 unexpected key, 严格加载时报错
+                continue
+            keys = [f'{prefix}{p}.linear.{name}' for p in ('query','key','value')]
+            if all(k in state_dict for k in keys):
+                state_dict[f'{prefix}qkv.{name}'] = torch.cat([state_dict.pop(k) for k in keys])
+        super()._load_from_state_dict(state_dict,prefix,*args,**kwargs)
+    def project(self,x:torch.Tensor,start:int,end:int):
+        #用 qkv 中第 start 到 end 块(0 查询, 1 键, 2 值)的权重投影 x, 并分割成多个头
+        #输入形状为[batch_size, seq_len, d_model], 输出形状为[end-start, batch_size, heads, seq_len, d_k]
+        batch_size,seq_len,_ = x.shape
+        if self.tp is not None:
+            x = copy_to_tensor_parallel_region(x,self.tp.group)
+        n = self.heads*self.d_k
+        weight = self.qkv.weight[start*n:end*n]
+        bias = None if self.qkv.bias is None else self.qkv.bias[start*n:end*n]
+        x = F.linear(x,weight,bias).view(batch_size,seq_len,end-start,self.heads,self.d_k)
+        return x.permute(2,0,3,1,4)
     def get_scores(self,query:torch.Tensor,key:torch.Tensor):
-        return torch.einsum("ibhd,jbhd->ijbh",query,key)
+        #计算缩放后的分数 QK^T/sqrt(d_k), 输出形状为[batch_size, heads, seq_len_q, seq_len_k]
+        #展平为[batch_size*heads, seq_len, d_k]后用一次 baddbmm 完成矩阵乘和缩放(cuBLAS/MKL 的批量 GEMM)
+        batch_size,heads,seq_len_q,d_k = query.shape
+        seq_len_k = key.shape[2]
+        query = query.reshape(batch_size*heads,seq_len_q,d_k)
+        key = key.reshape(batch_size*heads,seq_len_k,d_k)
+        scores = torch.empty(batch_size*heads,seq_len_q,seq_len_k,dtype=query.dtype,device=query.device)
+        scores = torch.baddbmm(scores,query,key.transpose(1,2),beta=0,alpha=self.scale)
+        return scores.view(batch_size,heads,seq_len_q,seq_len_k)
+    def can_use_flash_attn(self,query:torch.Tensor,mask:Optional[torch.Tensor],is_causal:bool):
+        #flash_attn 已安装、在 CUDA 上、没有任意形状的掩码时使用 FlashAttention-2。
+        #自定义算子没有注册反向, 因此只用于不需要梯度的推理; 训练时 SDPA 在 CUDA 上同样会选择 FlashAttention-2 的核
+        return (flash_attn_func is not None and query.is_cuda and not torch.is_grad_enabled()
+                and (mask is None or is_causal) and self.d_k <= 256)
     def prepare_mask(self,mask:torch.Tensor,query_shape:List[int],key_shape:List[int]):
+        #mask 的形状为[batch_size, seq_len_q, seq_len_k], 前两维可以为 1 以便广播
         assert mask.shape[0] == 1 or mask.shape[0] == query_shape[0]
-        assert mask.shape[1] == key_shape[0]
-        assert mask.shape[2] == 1 or mask.shape[2] == query_shape[1]         
-        mask = mask.unsqueeze(-1)
+        assert mask.shape[1] == 1 or mask.shape[1] == query_shape[2]
+        assert mask.shape[2] == key_shape[2]
+        #转为[batch_size, 1, seq_len_q, seq_len_k]的布尔掩码, True 表示可以注意
+        mask = (mask != 0).unsqueeze(1)
         return mask
     
-    def forward(self,*,query:torch.Tensor,key:torch.Tensor,value:torch.Tensor,mask:Optional[torch.Tensor] = None):
-        seq_len,batch_size,_ = query.shape
-        query = self.query(query)
-        key = self.key(key)
-        value = self.value(value)
-        scores = self.get_scores(query,key)
-        scores *= self.scale
+    def forward(self,*,query:torch.Tensor,key:torch.Tensor,value:torch.Tensor,mask:Optional[torch.Tensor] = None,
+                is_causal:bool = False):
+        #is_causal 为 True 时 mask 可以为 None, 或是已经准备好的[seq_len_q, seq_len_k]布尔下三角掩码(不再检查和变换)
+        #输入形状为[batch_size, seq_len, d_model]
+        batch_size,seq_len,_ = query.shape
+        if query is key and key is value:
+            #自注意力: 一次 GEMM 得到查询、键和值
+            query,key,value = self.project(query,0,3).unbind(0)
+        elif key is value:
+            #交叉注意力: 键和值来自同一个 memory, 也只需一次 GEMM
+            query = self.project(query,0,1)[0]
+            key,value = self.project(key,1,3).unbind(0)
+        else:
+            query = self.project(query,0,1)[0]
+            key = self.project(key,1,2)[0]
+            value = self.project(value,2,3)[0]
         
-        if mask is not None:
+        if mask is not None and not is_causal:
             mask = self.prepare_mask(mask,query.shape,key.shape) # type: ignore
         
-        if mask is not None:
-            scores = scores.masked_fill(mask==0,float('-inf'))
-        attn = self.softmax(scores)
-        #tracker.debug('attn',attn)
-        attn = self.dropout(attn)
-        x = torch.einsum("ijbh,jbhd->ibhd",attn,value)    
-    
-
+        if self.is_save_attn:
+            #分数是 baddbmm 新分配的张量, 原地填充掩码; 内联的 softmax 沿键所在的最后一维,
+            #torch.compile 可以把掩码填充和 softmax 融合成一个核
+            scores = self.get_scores(query,key)
+            if is_causal and mask is None:
+                mask = torch.ones(scores.shape[-2:],dtype=torch.bool,device=scores.device).tril()
+            if mask is not None:
+                scores.masked_fill_(~mask,float('-inf'))
+            attn = F.softmax(scores,dim=-1)
+            #tracker.debug('attn',attn)
+            self.attn = attn.detach()
+            attn = self.dropout(attn)
+            #展平为[batch_size*heads, seq_len_q, seq_len_k] x [batch_size*heads, seq_len_k, d_k], 用一次 bmm (批量 GEMM) 完成
+            x = torch.bmm(attn.flatten(0,1),value.flatten(0,1)).view(query.shape)
+            #[batch_size, heads, seq_len, d_k] -> [batch_size, seq_len, heads, d_k]
+            x = x.transpose(1,2)
+        elif self.can_use_flash_attn(query,mask,is_causal):
+            #FlashAttention-2 直接使用[batch_size, seq_len, heads, d_k]布局, 输出不需要再转置
+            dtype = query.dtype
+            if dtype not in (torch.float16,torch.bfloat16):
+                query,key,value = (t.to(torch.bfloat16) for t in (query,key,value))
+            x = flash_attention(query.transpose(1,2),key.transpose(1,2),value.transpose(1,2),
+                                self.dropout.p if self.training else 0.0,self.scale,is_causal)
+            x = x.to(dtype)
+        else:
+            #融合的注意力核(FlashAttention/memory-efficient),不物化[batch, heads, seq, seq]的分数张量
+            #因果注意力时不传掩码张量, flash 核会直接跳过被遮住的块
+            x = F.scaled_dot_product_attention(query,key,value,attn_mask=None if is_causal else mask,
+                                               dropout_p=self.dropout.p if self.training else 0.0,
+                                               is_causal=is_causal,scale=self.scale)
+            x = x.transpose(1,2)
         
-            
\ No newline at end of file
+        #[batch_size, seq_len, heads, d_k]
+        x = self.output(x.reshape(batch_size,seq_len,-1))
+        if self.tp is not None:
+            x = reduce_from_tensor_parallel_region(x,self.tp.group)
+            x = x + self.output_bias
+        return x
@@ -1,12 +1,26 @@
+import functools
+import itertools
 import math
-from typing import Optional
+from typing import List, Optional, Tuple
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from labml_nn.utils import clone_module_list
 from .FFN import FeedForward
 from .mha import MultiHeadAttention
+from .parallel import init_sharded_linear_
 from .positional_encoding import get_positional_encoding
 
+def transpose_legacy_positional_encodings(state_dict:dict,key:str):
+    '''
+    旧版本按[seq_len, batch_size, d_model]布局保存的位置编码形状为[max_len, 1, d_model], 加载时转为[1, max_len, d_model]
+    '''
+    pe = state_dict.get(key)
+    if pe is not None and pe.dim() == 3 and pe.shape[1] == 1 and pe.shape[0] != 1:
+        state_dict[key] = pe.transpose(0,1)
+
 class EmbeddingsWithPositionalEncoding(nn.Module):
     '''
     嵌入 token 并添加固定位置编码
@@ -15,11 +29,18 @@ class EmbeddingsWithPositionalEncoding(nn.Module):
         super().__init__()
         self.linear = nn.Embedding(n_vocab,d_model)
         self.d_model = d_model
+        self.scale = math.sqrt(d_model)
         self.register_buffer('positional_encodings',get_positional_encoding(d_model,max_len))
     
+    def _load_from_state_dict(self,state_dict,prefix,*args,**kwargs):
+        transpose_legacy_positional_encodings(state_dict,prefix + 'positional_encodings')
+        super()._load_from_state_dict(state_dict,prefix,*args,**kwargs)
+    
     def forward(self,x:torch.Tensor):
-        pe = self.positional_encodings[:x.shape[0]].required_grad_(False)
-        return self.linear(x)*math.sqrt(self.d_model) + pe    
+        # x 的形状为[batch_size, seq_len], buffer 本身不需要梯度, 直接切片即可
+        pe = self.positional_encodings[:,:x.shape[1]]
+        # 嵌入的输出是新张量, 原地缩放并加上位置编码
+        return self.linear(x).mul_(self.scale).add_(pe)
 
 class EmbeddingsWithLearnedPositionalEncoding(nn.Module):
     '''
@@ -29,10 +50,37 @@ class EmbeddingsWithLearnedPositionalEncoding(nn.Module):
         super().__init__()
         self.linear = nn.Embedding(n_vocab, d_model)
         self.d_model = d_model
-        self.positional_encodings = nn.Parameter(torch.zeros(max_len,1,d_model),requires_grad=True)
+        self.scale = math.sqrt(d_model)
+        self.positional_encodings = nn.Parameter(torch.zeros(1,max_len,d_model),requires_grad=True)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        transpose_legacy_positional_encodings(state_dict, prefix + 'positional_encodings')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     def forward(self, x: torch.Tensor):
-        pe = self.positional_encodings[:x.shape[0]].requires_grad_(False)
-        return self.linear(x) * math.sqrt(self.d_model) + pe
+        pe = self.positional_encodings[:, :x.shape[1]]
+        return self.linear(x).mul_(self.scale).add_(pe)
+
+def dropout_add_layer_norm(x:torch.Tensor,residual:torch.Tensor,norm:nn.LayerNorm,p:float,training:bool):
+    '''
+    计算 residual + dropout(x) 以及它的 LayerNorm, 返回 (新的残差, 归一化后的输出)。
+    写成一个函数后, torch.compile 会把 dropout、残差相加和 LayerNorm 融合为一个核, 激活只读写一次
+    '''
+    x = residual + F.dropout(x,p,training)
+    return x,F.layer_norm(x,norm.normalized_shape,norm.weight,norm.bias,norm.eps)
+
+def fold_layer_norm_bias(norm:nn.LayerNorm,*targets:Tuple[nn.Linear,int]):
+    '''
+    把 norm 的偏置 β 合并到读取它输出的线性层中: W(x̂γ + β) + b = W(x̂γ) + (Wβ + b), 之后 norm 不再有偏置。
+    targets 是 (linear, n), 只修改 linear 的前 n 个输出 (交叉注意力中只有查询来自 norm)
+    '''
+    if norm.bias is None:
+        return
+    with torch.no_grad():
+        for linear,n in targets:
+            if linear.bias is None:
+                linear.bias = nn.Parameter(linear.weight.new_zeros(linear.out_features))
+            delta = F.linear(norm.bias.float(),linear.weight[:n].float())
+            linear.bias[:n] += delta.to(linear.bias.dtype)
+        norm.bias = None
 
 class TransformerLayer(nn.Module):
     def __init__(self, *,
@@ -60,52 +108,212 @@ class TransformerLayer(nn.Module):
         self.norm_ff = nn.LayerNorm([d_model])
         # Whether to save input to the feed forward layer
         self.is_save_ff_input = False
-    def forward(self,*,x:torch.Tensor,
+    def forward(self,x:torch.Tensor,
                 mask:torch.Tensor,
                 src:torch.Tensor|None = None,
-                src_mask:torch.Tensor|None = None):
+                src_mask:torch.Tensor|None = None,
+                is_causal:bool = False):
         z = self.norm_self_attn(x)
-        self_attn = self.self_attn(query=z,value=z,key=z,mask=mask)
-        x = x + self.dropout(self_attn)
+        self_attn = self.self_attn(query=z,value=z,key=z,mask=mask,is_causal=is_causal)
+        # The residual add after each sub-layer is done together with the next
+        # layer normalization, returning both the residual stream and its normalized form
         if src is not None:
-            z = self.norm_src_attn(x)
-            if self.src_attn is not None:
-                attn_src = self.src_attn(query=z,key=src,value=src,mask=src_mask)      
-                x = x + self.dropout(attn_src)
-        z = self.norm_ff(x)
-        if self.is_save_ff_input:
-            self.ff_input = z.clone
+            x,z = dropout_add_layer_norm(self_attn,x,self.norm_src_attn,self.dropout.p,self.training)
+            attn_src = self.src_attn(query=z,key=src,value=src,mask=src_mask)
+            x,z = dropout_add_layer_norm(attn_src,x,self.norm_ff,self.dropout.p,self.training)
+        else:
+            x,z = dropout_add_layer_norm(self_attn,x,self.norm_ff,self.dropout.p,self.training)
+        # Saving a tensor on the module is a side effect that neither a TorchScript trace nor a
+        # `fullgraph=True` compile can replay, so it is skipped under both
+        if self.is_save_ff_input and not torch.jit.is_tracing() and not torch.compiler.is_compiling():
+            self.ff_input = z.clone()
         ff = self.feed_forward(z)
         x = x + self.dropout(ff)
         
         return x
+
+    def fuse_norm_bias(self):
+        """
+        Fold the bias of each layer normalization into the projections that read its output,
+        so the normalizations run without the bias add. The outputs are unchanged, but the
+        normalizations can no longer learn a bias, so only call this for inference after training.
+        """
+        fold_layer_norm_bias(self.norm_self_attn, (self.self_attn.qkv, self.self_attn.qkv.out_features))
+        if self.src_attn is not None:
+            # Only the queries of the source attention come from the normalized input
+            fold_layer_norm_bias(self.norm_src_attn, (self.src_attn.qkv, self.src_attn.qkv.out_features // 3))
+        targets = [(self.feed_forward.layer1, self.feed_forward.layer1.out_features)]
+        if self.feed_forward.is_gated and not self.feed_forward.is_fused_gate:
+            targets.append((self.feed_forward.linear_v, self.feed_forward.linear_v.out_features))
+        fold_layer_norm_bias(self.norm_ff, *targets)
+
+@functools.lru_cache(maxsize=None)
+def compile_stack(run_layers):
+    '''
+    用 torch.compile(fullgraph=True) 把整个层栈编译为一个图: 对各层的 Python 循环在图中展开, 没有逐层的解释器开销,
+    Inductor 同时融合 LayerNorm、dropout、残差相加和 FFN 的逐元素算子。
+    run_layers 是未绑定的函数(例如 Encoder.run_layers), 调用时把模块作为第一个参数传入; 编译结果按函数缓存,
+    模块本身不持有编译后的函数, 因此 deepcopy 得到的副本运行自己的参数, 模块也可以被 pickle
+    输入形状固定时使用 dynamic=False, max-autotune 会为融合后的 Triton 核做调优; 参数名和 state_dict 不变。
+    CUDA Graph 由 capture_graph/make_graphed 管理, 因此关闭 Inductor 自己的 cudagraphs, 否则 capture_graph
+    预热时会先录制 Inductor 的 graph, 再在外层的 torch.cuda.graph 中捕获它的 replay
+    '''
+    return torch.compile(run_layers,mode="max-autotune-no-cudagraphs",dynamic=False,fullgraph=True)
+
+def make_graphed_layers(layers:nn.ModuleList,sample_args:Tuple[torch.Tensor,...]):
+    '''
+    用 torch.cuda.make_graphed_callables 把每一层的前向和反向分别捕获为 CUDA Graph (原地替换各层的 forward),
+    训练时每层只需一次 graph replay, 省掉逐层的 Python 解释和 kernel launch 开销。
+    sample_args 是一层的位置参数, 必须都是 CUDA 张量, requires_grad 与实际输入一致, 之后的输入形状也必须相同;
+    train/eval 模式与捕获时不同时会自动回退到 eager
+    '''
+    # 每层使用独立的静态输入, 反向时各层保存的输入不会被后面的层覆盖
+    sample_args = tuple(tuple(a.detach().clone().requires_grad_(a.requires_grad) for a in sample_args) for _ in layers)
+    torch.cuda.make_graphed_callables(tuple(layers),sample_args)
+
+class CUDAGraphRunner:
+    '''
+    推理用: 把 fn(*args) 整体捕获为一个 CUDA Graph, 之后每次调用只需把输入拷入静态缓冲并 replay 一次。
+    只适用于形状固定的输入, 参数可以为 None (捕获时和调用时都必须为 None)
+    '''
+    def __init__(self,fn,*example_args:Optional[torch.Tensor]):
+        self.static_args = [None if a is None else a.clone() for a in example_args]
+        # 先在旁路 stream 上预热, cuBLAS 初始化、autotune 等不会被捕获进 graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream),torch.no_grad():
+            for _ in range(3):
+                fn(*self.static_args)
+        torch.cuda.current_stream().wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(),torch.cuda.graph(self.graph):
+            self.static_output = fn(*self.static_args)
+    
+    def matches(self,*args:Optional[torch.Tensor]):
+        return all((a is None and s is None) or
+                   (a is not None and s is not None and a.shape == s.shape and a.dtype == s.dtype and a.device == s.device)
+                   for a,s in zip(args,self.static_args))
+    
+    def __call__(self,*args:Optional[torch.Tensor]):
+        for s,a in zip(self.static_args,args):
+            if s is not None:
+                s.copy_(a)
+        self.graph.replay()
+        # 输出缓冲在下次 replay 时会被覆盖
+        return self.static_output.clone()
     
 class Encoder(nn.Module):
-    def __init__(self,layer:TransformerLayer,n_layers:int):
+    def __init__(self,layer:TransformerLayer,n_layers:int,compile_layers:bool = False):
+        '''
+        compile_layers 指定是否用 torch.compile 把所有层和最后的 LayerNorm 编译为一个图
+        '''
         super().__init__()
         self.layers = clone_module_list(layer,n_layers)
         self.norm = nn.LayerNorm([layer.size])
+        self.cuda_graph:Optional[CUDAGraphRunner] = None
+        self.compile_layers = compile_layers
     
-    def forward(self,x:torch.Tensor,mask:torch.Tensor):
+    def run_layers(self,x:torch.Tensor,mask:torch.Tensor):
         for layer in self.layers:
-            x = layer(x=x,mask=mask)
+            x = layer(x,mask)
         return self.norm(x)
+    
+    def run(self,x:torch.Tensor,mask:torch.Tensor):
+        # compile_layers 时运行编译后的层栈, 否则直接运行 run_layers
+        if self.compile_layers:
+            return compile_stack(type(self).run_layers)(self,x,mask)
+        return self.run_layers(x,mask)
+    
+    def forward(self,x:torch.Tensor,mask:torch.Tensor):
+        # 推理且形状与捕获时一致时 replay CUDA Graph, 否则走 eager
+        if (self.cuda_graph is not None and not self.training and not torch.is_grad_enabled()
+                and self.cuda_graph.matches(x,mask)):
+            return self.cuda_graph(x,mask)
+        return self.run(x,mask)
+    
+    def capture_graph(self,x:torch.Tensor,mask:torch.Tensor):
+        '''
+        推理用: 把整个层栈(包括最后的 LayerNorm)捕获为一个 CUDA Graph, 需要先调用 eval()
+        '''
+        # 训练模式下 dropout 的随机数会被固定在 graph 中, 每次 replay 都使用相同的掩码
+        assert not self.training, 'capture_graph is for inference, call eval() first'
+        self.cuda_graph = None
+        self.cuda_graph = CUDAGraphRunner(self.run,x,mask)
+    
+    def make_graphed(self,x:torch.Tensor,mask:torch.Tensor):
+        '''
+        把每一层捕获为 CUDA Graph, x 和 mask 是形状固定的示例输入。
+        不能与 compile_layers 同时使用: graph replay 无法被 torch.compile 追踪进 fullgraph=True 的图中
+        '''
+        assert not self.compile_layers, 'make_graphed cannot be combined with compile_layers=True'
+        make_graphed_layers(self.layers,(x,mask))
             
 class Decoder(nn.Module):
-    def __init__(self, layer: TransformerLayer, n_layers: int):
+    def __init__(self, layer: TransformerLayer, n_layers: int, compile_layers: bool = False, max_len: int = 5000):
         super().__init__()
+        # Lower-triangular causal mask, built once and sliced to `[seq_len, seq_len]` when no `tgt_mask` is given
+        self.register_buffer('causal_mask', torch.ones(max_len, max_len, dtype=torch.bool).tril(), persistent=False)
         # Make copies of the transformer layer
         self.layers = clone_module_list(layer, n_layers)
         # Final normalization layer
         self.norm = nn.LayerNorm([layer.size])
+        # CUDA graph of the whole stack for fixed-shape inference
+        self.cuda_graph: Optional[CUDAGraphRunner] = None
+        # Whether the layers were replaced by graphed callables with `make_graphed`
+        self.is_graphed = False
+        # Optionally compile the whole stack into a single graph
+        self.compile_layers = compile_layers
 
-    def forward(self, x: torch.Tensor, memory: torch.Tensor, src_mask: torch.Tensor, tgt_mask: torch.Tensor):
+    def run_layers(self, x: torch.Tensor, memory: torch.Tensor, src_mask: torch.Tensor, tgt_mask: Optional[torch.Tensor]):
+        # Without a `tgt_mask` the self attention is causal; SDPA then skips the masked
+        # tiles itself and the cached mask is only used by the explicit attention path.
+        # Graphed layers only take the four tensors they were captured with, so they get
+        # the cached mask as an ordinary `[1, seq_len, seq_len]` mask instead
+        is_causal = tgt_mask is None and not self.is_graphed
+        if tgt_mask is None:
+            tgt_mask = self.causal_mask[:x.shape[1], :x.shape[1]]
+            if not is_causal:
+                tgt_mask = tgt_mask.unsqueeze(0)
         # Run through each transformer layer
         for layer in self.layers:
-            x = layer(x=x, mask=tgt_mask, src=memory, src_mask=src_mask)
+            if is_causal:
+                x = layer(x, tgt_mask, memory, src_mask, True)
+            else:
+                x = layer(x, tgt_mask, memory, src_mask)
         # Finally, normalize the vectors
         return self.norm(x)
 
+    def run(self, x: torch.Tensor, memory: torch.Tensor, src_mask: torch.Tensor, tgt_mask: Optional[torch.Tensor]):
+        # Run the compiled stack when `compile_layers` is set, otherwise `run_layers` itself
+        if self.compile_layers:
+            return compile_stack(type(self).run_layers)(self, x, memory, src_mask, tgt_mask)
+        return self.run_layers(x, memory, src_mask, tgt_mask)
+
+    def forward(self, x: torch.Tensor, memory: torch.Tensor, src_mask: torch.Tensor, tgt_mask: Optional[torch.Tensor] = None):
+        # Replay the captured graph at inference when the shapes match, otherwise run eagerly
+        if (self.cuda_graph is not None and not self.training and not torch.is_grad_enabled()
+                and self.cuda_graph.matches(x, memory, src_mask, tgt_mask)):
+            return self.cuda_graph(x, memory, src_mask, tgt_mask)
+        return self.run(x, memory, src_mask, tgt_mask)
+
+    def capture_graph(self, x: torch.Tensor, memory: torch.Tensor, src_mask: torch.Tensor, tgt_mask: Optional[torch.Tensor] = None):
+        # Capture the whole stack as one CUDA graph for inference; call `eval()` first,
+        # otherwise the dropout masks would be frozen into the graph
+        assert not self.training, 'capture_graph is for inference, call eval() first'
+        self.cuda_graph = None
+        self.cuda_graph = CUDAGraphRunner(self.run, x, memory, src_mask, tgt_mask)
+
+    def make_graphed(self, x: torch.Tensor, memory: torch.Tensor, src_mask: torch.Tensor, tgt_mask: Optional[torch.Tensor] = None):
+        # Capture each layer as a CUDA graph for fixed-shape inputs like these;
+        # graphed callables only take tensors, so the causal mask is passed explicitly
+        # as a `[1, seq_len, seq_len]` mask and the layers are captured on the non-causal path.
+        # This can't be combined with `compile_layers`: graph replay can't be traced into a `fullgraph=True` compile
+        assert not self.compile_layers, 'make_graphed cannot be combined with compile_layers=True'
+        if tgt_mask is None:
+            tgt_mask = self.causal_mask[:x.shape[1], :x.shape[1]].unsqueeze(0)
+        make_graphed_layers(self.layers, (x, tgt_mask, memory, src_mask))
+        self.is_graphed = True
+
 
 class Generator(nn.Module):
     def __init__(self, n_vocab:int,d_model:int) -> None:
@@ -114,30 +322,106 @@ class Generator(nn.Module):
     def forward(self,x):
         return self.projection(x)
 
+def xavier_init_targets(module:nn.Module):
+    '''
+    返回 module 中需要 Xavier 初始化的参数(维数大于 1), 以及每个参数沿第 0 维堆叠的独立矩阵个数;
+    融合的线性层用 fan_blocks 属性标明(例如门控 FFN 融合后的 layer1 为 2)。
+    张量并行切分的线性层(带 tp_shard 属性)要按完整形状初始化, 不在返回值中
+    '''
+    params,fan_blocks,seen = [],[],set()
+    for m in module.modules():
+        if hasattr(m,'tp_shard'):
+            continue
+        for name,p in m.named_parameters(recurse=False):
+            if p.dim() > 1 and id(p) not in seen:
+                seen.add(id(p))
+                params.append(p)
+                fan_blocks.append(getattr(m,'fan_blocks',1) if name == 'weight' else 1)
+    return params,fan_blocks
+
+def xavier_uniform_bulk_(params:List[torch.Tensor],fan_blocks:Optional[List[int]] = None,
+                         max_sample_numel:int = 1 << 24):
+    '''
+    与对每个参数调用 nn.init.xavier_uniform_ 等价, 但形状相同的参数一起采样随机数,
+    再用 _foreach_copy_ 批量写回, 深层模型初始化时的 kernel 启动次数从参数个数降为大约形状种类数。
+    fan_blocks[i] 是 params[i] 沿第 0 维堆叠的独立矩阵个数, 每块按自己的形状计算 fan_in/fan_out。
+    每次采样最多 max_sample_numel 个元素(至少一个参数), 临时缓冲不会达到同形状参数的总大小
+    '''
+    if fan_blocks is None:
+        fan_blocks = [1]*len(params)
+    buckets = {}
+    for p,blocks in zip(params,fan_blocks):
+        buckets.setdefault((p.shape,blocks,p.dtype,p.device),[]).append(p)
+    with torch.no_grad():
+        for (shape,blocks,dtype,device),bucket in buckets.items():
+            fan_in,fan_out = nn.init._calculate_fan_in_and_fan_out(bucket[0])
+            fan_out //= blocks
+            bound = math.sqrt(6.0 / (fan_in + fan_out))
+            chunk = max(1,max_sample_numel // max(1,bucket[0].numel()))
+            for i in range(0,len(bucket),chunk):
+                params_chunk = bucket[i:i + chunk]
+                samples = torch.empty(len(params_chunk),*shape,dtype=dtype,device=device).uniform_(-bound,bound)
+                torch._foreach_copy_(params_chunk,list(samples.unbind(0)))
+
 class EncoderDecoder(nn.Module):
     def __init__(self,encoder:Encoder,decoder:Decoder,src_embed:nn.Module,
-                 tgt_embed:nn.Module,generator:nn.Module) -> None:
+                 tgt_embed:nn.Module,generator:nn.Module,
+                 autocast_dtype:Optional[torch.dtype] = None) -> None:
+        '''
+        autocast_dtype 不为 None 时(例如 torch.bfloat16), forward 在该精度的 autocast 下运行,
+        GEMM 使用 Tensor Core, LayerNorm 仍以 FP32 计算
+        '''
         super().__init__()
+        self.autocast_dtype = autocast_dtype
         self.encoder = encoder
         self.decoder = decoder
         self.src_embed = src_embed
         self.tgt_embed = tgt_embed
         self.generator = generator
         
-        for p in self.parameters():
-            if p.dim() > 1:
-                nn.init.xavier_uniform_(p)
+        xavier_uniform_bulk_(*xavier_init_targets(self))
+        for m in self.modules():
+            if hasattr(m,'tp_shard'):
+                init_sharded_linear_(m,nn.init.xavier_uniform_)
     
-    def forward(self,src:torch.Tensor,tgt:torch.Tensor,
-                src_mask:torch.Tensor,tgt_mask:torch.Tensor):
-        def encode(self, src: torch.Tensor, src_mask: torch.Tensor):
-            return self.encoder(self.src_embed(src), src_mask)
+    def to_inference_dtype(self,dtype:torch.dtype = torch.bfloat16):
+        '''
+        推理用: 把除 LayerNorm 以外的参数和缓冲(包括位置编码)一次性转为 dtype, 并开启相同精度的 autocast,
+        之后每一步不再需要转换权重
+        '''
+        with torch.no_grad():
+            for module in self.modules():
+                if isinstance(module,nn.LayerNorm):
+                    continue
+                for t in itertools.chain(module.parameters(recurse=False),module.buffers(recurse=False)):
+                    if t.is_floating_point():
+                        t.data = t.data.to(dtype)
+        self.autocast_dtype = dtype
+        return self
+    
+    def wrap_ddp(self,device_ids:Optional[List[int]] = None,process_group:Optional[dist.ProcessGroup] = None):
+        '''
+        用 DistributedDataParallel 包装模型, 梯度按 bucket 做 all-reduce, 与反向计算重叠。
+        需要在构造函数完成参数初始化之后调用; torch.distributed.init_process_group('nccl') 由调用者负责。
+        使用张量并行时 process_group 必须是数据并行组, 即持有相同分片的 rank, 否则不同分片的梯度会被平均在一起。
+        static_graph=True 要求每次迭代参与计算的参数集合不变, DDP 可以据此重排梯度 bucket 并跳过未使用参数的查找
+        模型中的 buffer 只有位置编码和因果掩码, 它们是常量, 因此 broadcast_buffers=False, 省去每次前向前的广播
+        '''
+        return DistributedDataParallel(self,device_ids=device_ids,bucket_cap_mb=25,broadcast_buffers=False,
+                                       process_group=process_group,
+                                       gradient_as_bucket_view=True,static_graph=True)
+    
+    def encode(self, src: torch.Tensor, src_mask: torch.Tensor):
+        return self.encoder(self.src_embed(src), src_mask)
 
-        def decode(self, memory: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor):
-            return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)            
-        
-        enc = self.encoder(src,src_mask)
-        return self.decode(enc,src_mask,tgt,tgt_mask)    
+    def decode(self, memory: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: Optional[torch.Tensor] = None):
+        return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)
+    
+    def forward(self,src:torch.Tensor,tgt:torch.Tensor,
+                src_mask:torch.Tensor,tgt_mask:Optional[torch.Tensor] = None):
+        with torch.autocast(src.device.type,dtype=self.autocast_dtype,enabled=self.autocast_dtype is not None):
+            enc = self.encode(src,src_mask)
+            return self.generator(self.decode(enc,src_mask,tgt,tgt_mask))
 
         
         
@@ -0,0 +1,99 @@
+import math
+from typing import Callable, Optional
+
+import torch
+from torch import nn
+import torch.distributed as dist
+
+
+class _CopyToTensorParallelRegion(torch.autograd.Function):
+    '''
+    前向为恒等; 反向对梯度做 all-reduce, 因为每个 rank 只算出了输入梯度中属于自己那部分权重的贡献
+    '''
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, group: Optional[dist.ProcessGroup]):
+        ctx.group = group
+        return x
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        dist.all_reduce(grad, group=ctx.group)
+        return grad, None
+
+
+class _ReduceFromTensorParallelRegion(torch.autograd.Function):
+    '''
+    前向对各 rank 的部分结果做 all-reduce; 反向为恒等, 梯度在各 rank 上已经相同
+    '''
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, group: Optional[dist.ProcessGroup]):
+        dist.all_reduce(x, group=group)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        return grad, None
+
+
+def copy_to_tensor_parallel_region(x: torch.Tensor, group: Optional[dist.ProcessGroup]):
+    '''
+    在按列切分的线性层之前调用
+    '''
+    return _CopyToTensorParallelRegion.apply(x, group)
+
+
+def reduce_from_tensor_parallel_region(x: torch.Tensor, group: Optional[dist.ProcessGroup]):
+    '''
+    在按行切分的线性层之后调用, 把各 rank 的部分和相加
+    '''
+    return _ReduceFromTensorParallelRegion.apply(x, group)
+
+
+class TensorParallelGroup:
+    '''
+    张量并行的进程组及本 rank 在组内的位置。
+    ProcessGroup 不能被复制, 而 clone_module_list 会 deepcopy 整个层, 因此复制时返回自身, 所有副本共享同一个组。
+    各 rank 使用相同的随机种子; 切分区域内的 dropout(FFN 隐藏层、注意力权重)因此在各 rank 的分片上使用相同的掩码序列
+    '''
+    def __init__(self, group: dist.ProcessGroup):
+        self.group = group
+        self.size = dist.get_world_size(group)
+        self.rank = dist.get_rank(group)
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def init_sharded_linear_(linear: nn.Linear, weight_init: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+                         bias: Optional[torch.Tensor] = None):
+    '''
+    初始化按 tp_shard = (dim, tp) 切分的线性层: 先生成未切分的完整权重, 再取出本 rank 的部分,
+    fan_in/fan_out 因此按完整形状计算, 各 rank 的分片拼起来就是一次完整的初始化。
+    所有 rank 必须使用相同的随机种子, 这样复制的参数和残差 dropout 在各 rank 上也保持一致。
+    weight_init 为 None 时按 nn.Linear 的默认方式初始化权重和偏置, 否则只用 weight_init 初始化权重;
+    fan_blocks 个堆叠的矩阵分别初始化、分别切分。
+    按行切分的层本身没有偏置, 它在 all-reduce 之后单独加, 通过 bias 传入; 这个偏置在各 rank 上是完整的副本
+    '''
+    dim, tp = linear.tp_shard
+    blocks = getattr(linear, 'fan_blocks', 1)
+    if dim == 0:
+        bias = linear.bias
+    init_bias = weight_init is None and bias is not None
+    if weight_init is None:
+        weight_init = lambda w: nn.init.kaiming_uniform_(w, a=math.sqrt(5))
+
+    def shard(full: torch.Tensor, dim: int):
+        return torch.cat([blk.chunk(tp.size, dim)[tp.rank] for blk in full.chunk(blocks, dim)], dim)
+
+    with torch.no_grad():
+        full_shape = list(linear.weight.shape)
+        full_shape[dim] *= tp.size
+        full = linear.weight.new_empty(full_shape)
+        for blk in full.chunk(blocks, dim):
+            weight_init(blk)
+        linear.weight.copy_(shard(full, dim))
+        if init_bias:
+            # 与 nn.Linear 相同, 边界由完整的 fan_in 决定
+            bound = 1 / math.sqrt(full_shape[1])
+            full_bias = full.new_empty(full_shape[0]).uniform_(-bound, bound)
+            bias.copy_(shard(full_bias, 0) if dim == 0 else full_bias)
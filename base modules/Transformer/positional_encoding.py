@@ -9,7 +9,8 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(dropout_prob)
         self.register_buffer('positional_encodings', get_positional_encoding(d_model, max_len), False)
     def forward(self,x:torch.Tensor):
-        pe = self.positional_encodings[:x.shape[0]].detach().requires_grad_(False)
+        #x 的形状为[batch_size, seq_len, d_model]
+        pe = self.positional_encodings[:,:x.shape[1]].detach().requires_grad_(False)
         x = x + pe
         x = self.dropout(x)
         return x    
@@ -21,7 +22,8 @@ def get_positional_encoding(d_model:int,max_len:int = 5000):
     div_term = torch.exp(two_i * -(math.log(10000.0) / d_model))
     encodings[:, 0::2] = torch.sin(position * div_term)
     encodings[:, 1::2] = torch.cos(position * div_term)
-    encodings = encodings.unsqueeze(1).requires_grad_(False)
+    #[1, max_len, d_model], 可以直接广播到[batch_size, seq_len, d_model]
+    encodings = encodings.unsqueeze(0).requires_grad_(False)
     return encodings
 
 
@@ -30,7 +32,7 @@ def _test_positional_encoding():
 
     plt.figure(figsize=(15, 5))
     pe = get_positional_encoding(20, 100)
-    plt.plot(np.arange(100), pe[:, 0, 4:8].numpy())
+    plt.plot(np.arange(100), pe[0, :, 4:8].numpy())
     plt.legend(["dim %d" % p for p in [4, 5, 6, 7]])
     plt.title("Positional encoding")
     plt.show()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The Transformer package lives under "base modules", which is not an importable name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'base modules'))
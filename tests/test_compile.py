@@ -0,0 +1,52 @@
+import copy
+import io
+
+import torch
+
+from Transformer.FFN import FeedForward
+from Transformer.mha import MultiHeadAttention
+from Transformer.models import Decoder, Encoder, TransformerLayer
+
+D_MODEL, HEADS = 16, 2
+
+
+def _layer(src_attn):
+    return TransformerLayer(d_model=D_MODEL, self_attn=MultiHeadAttention(HEADS, D_MODEL),
+                            src_attn=MultiHeadAttention(HEADS, D_MODEL) if src_attn else None,
+                            feed_forward=FeedForward(D_MODEL, 32), dropout_prob=0.1)
+
+
+def test_compiled_stack_copies_run_their_own_parameters():
+    torch.manual_seed(0)
+    encoder = Encoder(_layer(False), 2, compile_layers=True).eval()
+    decoder = Decoder(_layer(True), 2, compile_layers=True).eval()
+    x = torch.randn(2, 5, D_MODEL)
+    mask = torch.ones(2, 1, 5)
+
+    with torch.no_grad():
+        memory = encoder(x, mask)
+        out = decoder(x, memory, mask)
+        encoder_copy = copy.deepcopy(encoder)
+        decoder_copy = copy.deepcopy(decoder)
+        for p in list(encoder_copy.parameters()) + list(decoder_copy.parameters()):
+            p.zero_()
+        # The copies compute with their zeroed parameters, and the originals are untouched
+        torch.testing.assert_close(encoder_copy(x, mask), encoder_copy.run_layers(x, mask))
+        torch.testing.assert_close(decoder_copy(x, memory, mask), decoder_copy.run_layers(x, memory, mask, None))
+        assert not torch.allclose(encoder_copy(x, mask), memory)
+        torch.testing.assert_close(encoder(x, mask), memory)
+        torch.testing.assert_close(decoder(x, memory, mask), out)
+
+
+def test_compiled_stack_can_be_pickled():
+    torch.manual_seed(0)
+    encoder = Encoder(_layer(False), 2, compile_layers=True).eval()
+    x = torch.randn(2, 5, D_MODEL)
+    mask = torch.ones(2, 1, 5)
+
+    buffer = io.BytesIO()
+    torch.save(encoder, buffer)
+    buffer.seek(0)
+    loaded = torch.load(buffer, weights_only=False)
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(x, mask), encoder(x, mask))
@@ -0,0 +1,46 @@
+import pytest
+import torch
+from torch import nn
+
+from Transformer.FFN import FeedForward
+from Transformer.mha import MultiHeadAttention
+from Transformer.models import (Decoder, EmbeddingsWithPositionalEncoding, Encoder, EncoderDecoder, Generator,
+                                TransformerLayer)
+
+D_MODEL, HEADS, VOCAB = 32, 4, 50
+
+
+def _layer(src_attn, **ffn_kwargs):
+    return TransformerLayer(d_model=D_MODEL, self_attn=MultiHeadAttention(HEADS, D_MODEL),
+                            src_attn=MultiHeadAttention(HEADS, D_MODEL) if src_attn else None,
+                            feed_forward=FeedForward(D_MODEL, 64, **ffn_kwargs), dropout_prob=0.1)
+
+
+@pytest.mark.parametrize('ffn_kwargs', [
+    {},
+    dict(is_gated=True, activation='silu'),
+    dict(is_gated=True, bias1=False, bias_gate=True),
+], ids=['plain', 'fused-gate', 'unfused-gate'])
+def test_fuse_norm_bias_keeps_outputs(ffn_kwargs):
+    torch.manual_seed(0)
+    model = EncoderDecoder(Encoder(_layer(False, **ffn_kwargs), 2), Decoder(_layer(True, **ffn_kwargs), 2),
+                           EmbeddingsWithPositionalEncoding(D_MODEL, VOCAB),
+                           EmbeddingsWithPositionalEncoding(D_MODEL, VOCAB), Generator(VOCAB, D_MODEL)).eval()
+    # LayerNorm biases start at zero, which would make the folding trivially exact
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.LayerNorm):
+                m.bias.normal_()
+    src = torch.randint(0, VOCAB, (2, 5))
+    tgt = torch.randint(0, VOCAB, (2, 6))
+    src_mask = torch.ones(2, 1, 5)
+
+    with torch.no_grad():
+        expected = model(src, tgt, src_mask)
+        for layer in list(model.encoder.layers) + list(model.decoder.layers):
+            layer.fuse_norm_bias()
+        actual = model(src, tgt, src_mask)
+
+    for layer in list(model.encoder.layers) + list(model.decoder.layers):
+        assert layer.norm_self_attn.bias is None and layer.norm_ff.bias is None
+    torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from Transformer.mha import MultiHeadAttention
+
+HEADS, D_MODEL = 4, 16
+
+
+def _legacy_state_dict(mha):
+    # The layout saved before query, key and value were fused: separate `PrepareForMultiHeadAttention`
+    # projections, which always had a bias
+    state = {f'output.{k}': v for k, v in mha.output.state_dict().items()}
+    weights = mha.qkv.weight.detach().chunk(3)
+    biases = mha.qkv.bias.detach().chunk(3) if mha.qkv.bias is not None else [torch.randn(D_MODEL)] * 3
+    for name, w, b in zip(('query', 'key', 'value'), weights, biases):
+        state[f'{name}.linear.weight'] = w.clone()
+        state[f'{name}.linear.bias'] = b.clone()
+    return state
+
+
+def test_load_legacy_layout():
+    torch.manual_seed(0)
+    source = MultiHeadAttention(HEADS, D_MODEL, 0.0)
+    target = MultiHeadAttention(HEADS, D_MODEL, 0.0)
+    target.load_state_dict(_legacy_state_dict(source))
+    x = torch.randn(2, 5, D_MODEL)
+    torch.testing.assert_close(target(query=x, key=x, value=x), source(query=x, key=x, value=x))
+
+
+def test_load_legacy_biases_without_bias():
+    torch.manual_seed(0)
+    state = _legacy_state_dict(MultiHeadAttention(HEADS, D_MODEL, 0.0, bias=False))
+    target = MultiHeadAttention(HEADS, D_MODEL, 0.0, bias=False)
+    # The legacy biases can't be loaded, so strict loading reports them instead of dropping them
+    with pytest.raises(RuntimeError, match=r'Unexpected key\(s\) in state_dict: "query.linear.bias"'):
+        target.load_state_dict(state)
+    result = target.load_state_dict(state, strict=False)
+    assert sorted(result.unexpected_keys) == [f'{n}.linear.bias' for n in ('key', 'query', 'value')]
+    assert target.qkv.bias is None
+    torch.testing.assert_close(target.qkv.weight, torch.cat([state[f'{n}.linear.weight'] for n in ('query', 'key', 'value')]))
@@ -0,0 +1,121 @@
+import copy
+import math
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+WORLD_SIZE = 2
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, port, fn):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=WORLD_SIZE)
+    try:
+        fn(rank, dist.new_group(list(range(WORLD_SIZE))))
+    finally:
+        dist.destroy_process_group()
+
+
+def _spawn(fn):
+    mp.spawn(_worker, args=(_free_port(), fn), nprocs=WORLD_SIZE)
+
+
+def _shard(t, dim, rank, blocks=1):
+    return torch.cat([blk.chunk(WORLD_SIZE, dim)[rank] for blk in t.chunk(blocks, dim)], dim)
+
+
+def _check_grads(full, part, x, forward=lambda m, x: m(x)):
+    x = x.requires_grad_()
+    x2 = x.detach().clone().requires_grad_()
+    a = forward(full, x)
+    b = forward(part, x2)
+    a.square().sum().backward()
+    b.square().sum().backward()
+    torch.testing.assert_close(b, a)
+    torch.testing.assert_close(x2.grad, x.grad)
+
+
+def _ffn_matches_unsharded(rank, group):
+    from Transformer.FFN import FeedForward
+    for kw in ({}, dict(is_gated=True, activation='silu'), dict(is_gated=True, bias1=False, bias_gate=True)):
+        torch.manual_seed(0)
+        full = FeedForward(8, 16, dropout=0.0, **kw)
+        part = FeedForward(8, 16, dropout=0.0, tp_group=group, **kw)
+        with torch.no_grad():
+            blocks = 2 if full.is_fused_gate else 1
+            part.layer1.weight.copy_(_shard(full.layer1.weight, 0, rank, blocks))
+            if full.layer1.bias is not None:
+                part.layer1.bias.copy_(_shard(full.layer1.bias, 0, rank, blocks))
+            if hasattr(full, 'linear_v'):
+                part.linear_v.weight.copy_(_shard(full.linear_v.weight, 0, rank))
+                part.linear_v.bias.copy_(_shard(full.linear_v.bias, 0, rank))
+            part.layer2.weight.copy_(_shard(full.layer2.weight, 1, rank))
+            part.bias2.copy_(full.layer2.bias)
+        _check_grads(full, part, torch.randn(2, 3, 8))
+
+
+def _mha_matches_unsharded(rank, group):
+    from Transformer.mha import MultiHeadAttention
+    torch.manual_seed(0)
+    full = MultiHeadAttention(4, 16, 0.0)
+    part = MultiHeadAttention(4, 16, 0.0, tp_group=group)
+    with torch.no_grad():
+        part.qkv.weight.copy_(_shard(full.qkv.weight, 0, rank, 3))
+        part.qkv.bias.copy_(_shard(full.qkv.bias, 0, rank, 3))
+        part.output.weight.copy_(_shard(full.output.weight, 1, rank))
+        part.output_bias.copy_(full.output.bias)
+    _check_grads(full, part, torch.randn(2, 5, 16), lambda m, x: m(query=x, key=x, value=x))
+
+
+def _init_is_full_shape(rank, group):
+    from Transformer.FFN import FeedForward
+    from Transformer.mha import MultiHeadAttention
+    from Transformer.models import (Decoder, EmbeddingsWithPositionalEncoding, Encoder, EncoderDecoder,
+                                    Generator, TransformerLayer)
+    d_model, d_ff, heads, vocab = 16, 64, 4, 11
+
+    def layer(src):
+        return TransformerLayer(d_model=d_model, self_attn=MultiHeadAttention(heads, d_model, tp_group=group),
+                                src_attn=MultiHeadAttention(heads, d_model, tp_group=group) if src else None,
+                                feed_forward=FeedForward(d_model, d_ff, is_gated=True, tp_group=group),
+                                dropout_prob=0.1)
+
+    # Every rank uses the same seed; the layers are built through clone_module_list (deepcopy)
+    torch.manual_seed(0)
+    model = EncoderDecoder(Encoder(layer(False), 2), Decoder(layer(True), 2),
+                           EmbeddingsWithPositionalEncoding(d_model, vocab),
+                           EmbeddingsWithPositionalEncoding(d_model, vocab), Generator(vocab, d_model))
+    ff = model.encoder.layers[1].feed_forward
+    assert ff.tp is model.encoder.layers[0].feed_forward.tp
+
+    for name, p in model.named_parameters():
+        gathered = [torch.empty_like(p) for _ in range(WORLD_SIZE)]
+        dist.all_gather(gathered, p.detach())
+        sharded = name.endswith(('qkv.weight', 'qkv.bias', 'layer1.weight', 'layer1.bias', 'output.weight',
+                                 'layer2.weight'))
+        assert torch.equal(gathered[0], gathered[1]) != sharded, name
+
+    # The fused gate is two $[d_{ff}, d_{model}]$ matrices, and the sharded $W_2$ is $[d_{model}, d_{ff}]$
+    bound = math.sqrt(6 / (d_model + d_ff))
+    assert ff.layer1.weight.abs().max() <= bound
+    assert ff.layer2.weight.abs().max() <= bound
+    assert ff.layer1.weight.abs().max() > bound * 0.9
+    # The biases added after the all-reduce follow nn.Linear's default with the full fan_in
+    attn = model.encoder.layers[0].self_attn
+    for bias, fan_in in ((ff.bias2, d_ff), (attn.output_bias, d_model)):
+        assert bias.abs().max() <= 1 / math.sqrt(fan_in)
+        assert bias.abs().max() > 0.5 / math.sqrt(fan_in)
+    assert copy.deepcopy(ff).tp is ff.tp
+
+
+@pytest.mark.parametrize('fn', [_ffn_matches_unsharded, _mha_matches_unsharded, _init_is_full_shape])
+def test_tensor_parallel(fn):
+    _spawn(fn)